@@ -1,10 +1,78 @@
 import chess
 import chess.polyglot
 import click
+import copy
+import queue
 import random
+from concurrent.futures import ThreadPoolExecutor
 from pathlib import Path
-from itertools import repeat
-from pathos.pools import ProcessPool
+
+# Transposition table entry flags
+EXACT, LOWER, UPPER = range(3)
+
+# Amount of threads searching moves at the same time
+THREADS = 6
+
+# Transposition table entries kept before it is cleared
+TT_SIZE = 2 ** 20
+
+# Half width of the aspiration window around the previous iteration's score
+ASPIRATION_WINDOW = 50
+
+# Depth reduction of the search after a null move
+NULL_MOVE_REDUCTION = 2
+
+# Moves searched at full depth before later quiet moves get reduced
+FULL_DEPTH_MOVES = 4
+
+# Piece values indexed by piece type
+PIECE_VALUES = (0, 100, 300, 300, 500, 900, 500)
+
+# Piece square tables indexed by piece type and square, from white's view
+PST_WHITE = (
+    (),
+
+    (  0,  0,  0,  0,  0,  0,  0,  0,
+       5, 10, 10,-25,-25, 10, 10,  5,
+       5, -5,-10,  0,  0,-10, -5,  5,
+       5,  0,  0, 25, 25,  0,  0,  5,
+       5,  5, 10, 27, 27, 10,  5,  5,
+      10, 10, 20, 30, 30, 20, 10, 10,
+      50, 50, 50, 50, 50, 50, 50, 50,
+       0,  0,  0,  0,  0,  0,  0,  0),
+
+    (-50,-40,-30,-30,-30,-30,-40,-50,
+     -40,-20,  0,  0,  0,  0,-20,-40,
+     -30,  0, 10, 15, 15, 10,  0,-30,
+     -30,  5, 15, 20, 20, 15,  5,-30,
+     -30,  0, 15, 20, 20, 15,  0,-30,
+     -30,  5, 10, 15, 15, 10,  5,-30,
+     -40,-20,  0,  5,  5,  0,-20,-40,
+     -50,-40,-20,-30,-30,-20,-40,-50),
+
+    (-20,-10,-10,-10,-10,-10,-10,-20,
+     -10, 15,  0,  0,  0,  0, 15,-10,
+     -10, 10, 10, 10, 10, 10, 10,-10,
+     -10,  0, 15, 10, 10, 15,  0,-10,
+     -10,  5,  5, 10, 10,  5,  5,-10,
+     -10,  0,  5, 10, 10,  5,  0,-10,
+     -10,  0,  0,  0,  0,  0,  0,-10,
+     -20,-10,-40,-10,-10,-40,-10,-20),
+
+    (0,) * 64, (0,) * 64,
+
+    ( 20, 30, 10,  0,  0, 10, 30, 20,
+      20, 20,  0,  0,  0,  0, 20, 20,
+     -10,-20,-20,-20,-20,-20,-20,-10,
+     -20,-30,-30,-40,-40,-30,-30,-20,
+     -30,-40,-40,-50,-50,-40,-40,-30,
+     -30,-40,-40,-50,-50,-40,-40,-30,
+     -30,-40,-40,-50,-50,-40,-40,-30,
+     -30,-40,-40,-50,-50,-40,-40,-30),
+)
+
+# Tables for black are the white ones flipped vertically
+PST_BLACK = ((),) + tuple(tuple(table[square ^ 56] for square in range(64)) for table in PST_WHITE[1:])
 
 
 class ChessEngine:
@@ -14,6 +82,17 @@ class ChessEngine:
         """Initialize the playing side and the opening book."""
         self.side = chess.WHITE if side == "White" else chess.BLACK
         self.move_evals = []
+        # Transposition table: zobrist key -> (depth, score, flag, best move)
+        self.tt = {}
+        # Quiet moves that caused beta cutoffs, by ply
+        self.killers = {}
+        # Game score from the side to move's view, updated move by move during search
+        self.score = 0
+        self.score_deltas = []
+        # Positions visited by the last search
+        self.nodes = 0
+        # Search threads are kept for the whole game
+        self.pool = ThreadPoolExecutor(max_workers=THREADS)
         try:
             ob_file = Path(__file__).parent / "opening_books" / ".bin"
             self.opening_book = chess.polyglot.MemoryMappedReader(ob_file)
@@ -21,11 +100,11 @@ class ChessEngine:
             click.echo("No opening book was found.")
             self.opening_book = None
 
-    def next_move(self, board: chess.Board) -> str:
+    def next_move(self, board: chess.Board) -> chess.Move:
         """Find next move to be played by the engine.
 
         :param board: Current state of board
-        :returns: SAN of the move to be played
+        :returns: the move to be played
         """
         # All the currently legal moves
         uci_moves = list(board.legal_moves)
@@ -33,45 +112,94 @@ class ChessEngine:
 
         # Play a move from the opening book if book suggests one
         if self.opening_book:
-            try:
-                opening_move = board.san(self.opening_book.weighted_choice(board).move)
+            opening_moves = self.check_opening_sequence(board)
+            if opening_moves:
                 click.echo("This is from the opening book.")
-                return opening_move
-            except IndexError:
-                pass
+                return opening_moves[0]
 
-        # Search for move values
-        self.move_evals = []
-        '''
-        with click.progressbar(uci_moves, label="Calculating", length=self.move_amount) as bar:
-            # Amazing loading bar progresses with each calculated move
-            for move in bar:
-                self.search_initializer(move, board)
-        '''
-        # Multiprocess searching
-        pool = ProcessPool(6)
-        board_list = [board for i in range(self.move_amount)]
-        self.move_evals = pool.map(self.search_initializer, uci_moves, board_list)
-
-        # Rank worthiest moves
-        self.move_evals.sort(key = lambda x: x[1])
-        self.move_evals.reverse()
-        remaining_moves = []
-        for i in self.move_evals:
-            if self.move_evals[0][1] == i[1]:
-                remaining_moves.append(board.san(i[0]))
-            else:
-                break
+        # Search for move values on multiple threads
+        if len(self.tt) > TT_SIZE:
+            self.tt.clear()
+        self.move_evals = self.parallel_search(board, uci_moves)
+
+        # Find worthiest moves
+        best_score = max(score for _, score in self.move_evals)
+        remaining_moves = [move for move, score in self.move_evals if score == best_score]
 
         # Pick one of the worthiest moves
-        reasoning = (f"Total moves: {self.move_amount}\nPossible best moves: " +
-        f"{remaining_moves}\nWith evaluated score: {self.move_evals[0][1]/100}\n")
-        random.shuffle(remaining_moves)
+        reasoning = (f"Total moves: {self.move_amount}\nNodes searched: {self.nodes}\n" +
+        f"Possible best moves: {[move.uci() for move in remaining_moves]}\n" +
+        f"With evaluated score: {best_score/100}\n")
         click.echo(reasoning)
-        return remaining_moves[0]
+        return random.choice(remaining_moves)
+
+    def parallel_search(self, board: chess.Board, moves: list) -> list:
+        """Search moves on threads sharing the transposition table.
+
+        Every thread takes moves from a common queue and searches them on its
+        own copy of the board, so positions found by one thread are reused by
+        the others.
+
+        :param board: Current state of board
+        :param moves: Moves to be searched
+        :returns: list of (move, score) in the same order as moves
+        """
+        move_queue = queue.Queue()
+        for index, move in enumerate(moves):
+            move_queue.put((index, move))
+        move_evals = [None] * len(moves)
+
+        def work():
+            searcher = self.searcher()
+            search_board = board.copy()
+            while True:
+                try:
+                    index, move = move_queue.get_nowait()
+                except queue.Empty:
+                    return searcher.nodes
+                move_evals[index] = searcher.search_initializer(move, search_board)
+
+        workers = [self.pool.submit(work) for _ in range(THREADS)]
+        self.nodes = sum(worker.result() for worker in workers)
+        return move_evals
+
+    def searcher(self) -> "ChessEngine":
+        """Create a copy of the engine for one search thread.
+
+        The copy shares the transposition table but keeps its own killer
+        moves, incremental score and node count.
+        """
+        searcher = copy.copy(self)
+        searcher.killers = {}
+        searcher.nodes = 0
+        searcher.score_deltas = []
+        return searcher
+
+    def close(self):
+        """Stop the search threads and unmap the opening book once the game is over."""
+        self.pool.shutdown()
+        if self.opening_book:
+            self.opening_book.close()
 
     def search_initializer(self, move: chess.Move, board: chess.Board):
-        """Begin searching and evaluating values for a move."""
+        """Begin searching and evaluating values for a move.
+
+        The move is searched with iterative deepening so that every shallower
+        iteration fills the transposition table for the next one.
+        """
+        depth = self.search_depth(board)
+        score = self.score_board(board)
+        self.score = score if board.turn else -score
+        self.score_deltas = []
+        self.make(board, move)
+        score = self.alphaBeta(board, -100000, 100000, 1, 1)
+        for iteration_depth in range(2, depth + 1):
+            score = self.aspiration_search(board, score, iteration_depth)
+        self.unmake(board)
+        return (move, -score)
+
+    def search_depth(self, board: chess.Board) -> int:
+        """Choose how deep to search the moves of the current position."""
         depth = 1
         if self.move_amount >= 36:
             depth = 1
@@ -81,94 +209,164 @@ class ChessEngine:
             depth = 3
         elif self.move_amount < 18 or len(board.piece_map()) <= 8:
             depth = 6
-        board.push(move)
-        score = -self.alphaBeta(board, -100000, 100000, depth)
-        board.pop()
-        return (move, score)
+        return depth
+
+    def aspiration_search(self, board: chess.Board, score: int, depth: int) -> int:
+        """Search in a narrow window around the previous iteration's score.
+
+        :param score: Score of the previous iteration
+        :param depth: Depth of search
+        """
+        alpha = score - ASPIRATION_WINDOW
+        beta = score + ASPIRATION_WINDOW
+        score = self.alphaBeta(board, alpha, beta, depth, 1)
+        if score <= alpha or score >= beta:
+            # The real score is outside the window, search again with a full one
+            score = self.alphaBeta(board, -100000, 100000, depth, 1)
+        return score
 
     def check_opening_sequence(self, board: chess.Board) -> list:
-        """Get all next moves suggested by an opening book.
+        """Get a next move suggested by an opening book.
+
+        The move is picked at random by the weights of the book entries.
 
         :param board: Current state of board
-        :returns: list of decent moves
+        :returns: list with the book move, empty if the book has none
         """
-        opening_moves = []
-        for entry in self.opening_book.find_all(board):
-            move_san = board.san(entry.move)
-            opening_moves.append(move_san)
-        return opening_moves
+        try:
+            return [self.opening_book.weighted_choice(board).move]
+        except IndexError:
+            return []
 
     def evaluate_board(self, board: chess.Board) -> int:
-        """Calculate current game score.
+        """Get current game score from the side to move's view.
+
+        :param board: Current state of board, reached with make()
+        :returns: current game score
+        """
+        return self.score
+
+    def score_board(self, board: chess.Board) -> int:
+        """Calculate game score from white's view from scratch.
 
         :param board: Current state of board
         :returns: current game score
         """
-        piece = {1: 100, 2:300, 3:300, 4:500, 5:900, 6:500}
-        # Piece square tables
-        pst = {
-            1: [0,  0,  0,  0,  0,  0,  0,  0,
-                5, 10, 10,-25,-25, 10, 10,  5,
-                5, -5,-10,  0,  0,-10, -5,  5,
-                5,  0,  0, 25, 25,  0,  0,  5,
-                5,  5, 10, 27, 27, 10,  5,  5,
-                10, 10, 20, 30, 30, 20, 10, 10,
-                50, 50, 50, 50, 50, 50, 50, 50,
-                0,  0,  0,  0,  0,  0,  0,  0],
-
-            2: [-50,-40,-30,-30,-30,-30,-40,-50,
-                -40,-20,  0,  0,  0,  0,-20,-40,
-                -30,  0, 10, 15, 15, 10,  0,-30,
-                -30,  5, 15, 20, 20, 15,  5,-30,
-                -30,  0, 15, 20, 20, 15,  0,-30,
-                -30,  5, 10, 15, 15, 10,  5,-30,
-                -40,-20,  0,  5,  5,  0,-20,-40,
-                -50,-40,-20,-30,-30,-20,-40,-50,],
-
-            3: [-20,-10,-10,-10,-10,-10,-10,-20,
-                -10, 15,  0,  0,  0,  0, 15,-10,
-                -10, 10, 10, 10, 10, 10, 10,-10,
-                -10,  0, 15, 10, 10, 15,  0,-10,
-                -10,  5,  5, 10, 10,  5,  5,-10,
-                -10,  0,  5, 10, 10,  5,  0,-10,
-                -10,  0,  0,  0,  0,  0,  0,-10,
-                -20,-10,-40,-10,-10,-40,-10,-20,],
-
-            4: [0] * 64, 5: [0] * 64,
-
-            6: [ 20,  30,  10,   0,   0,  10,  30,  20,
-                 20,  20,   0,   0,   0,   0,  20,  20,
-                -10, -20, -20, -20, -20, -20, -20, -10,
-                -20, -30, -30, -40, -40, -30, -30, -20,
-                -30, -40, -40, -50, -50, -40, -40, -30,
-                -30, -40, -40, -50, -50, -40, -40, -30,
-                -30, -40, -40, -50, -50, -40, -40, -30,
-                -30, -40, -40, -50, -50, -40, -40, -30]
-        }
+        white = board.occupied_co[chess.WHITE]
+        black = board.occupied_co[chess.BLACK]
         score = 0
-        for pos in board.piece_map():
-            if board.color_at(pos):
-                score += pst[board.piece_type_at(pos)][pos] + piece[board.piece_type_at(pos)]
+        for piece_type, pieces in ((chess.PAWN, board.pawns), (chess.KNIGHT, board.knights),
+                                   (chess.BISHOP, board.bishops), (chess.ROOK, board.rooks),
+                                   (chess.QUEEN, board.queens), (chess.KING, board.kings)):
+            white_pieces = pieces & white
+            black_pieces = pieces & black
+            score += PIECE_VALUES[piece_type] * (chess.popcount(white_pieces) - chess.popcount(black_pieces))
+            # Walk the set bits of each bitboard, lowest square first
+            pst = PST_WHITE[piece_type]
+            while white_pieces:
+                score += pst[(white_pieces & -white_pieces).bit_length() - 1]
+                white_pieces &= white_pieces - 1
+            pst = PST_BLACK[piece_type]
+            while black_pieces:
+                score -= pst[(black_pieces & -black_pieces).bit_length() - 1]
+                black_pieces &= black_pieces - 1
+        return score
+
+    def make(self, board: chess.Board, move: chess.Move):
+        """Push a move and update the game score with its effect."""
+        delta = self.move_delta(board, move)
+        # The score changes hands along with the turn
+        self.score = -(self.score + delta)
+        self.score_deltas.append(delta)
+        board.push(move)
+
+    def unmake(self, board: chess.Board):
+        """Pop the last move and restore the game score before it."""
+        board.pop()
+        self.score = -self.score - self.score_deltas.pop()
+
+    def move_delta(self, board: chess.Board, move: chess.Move) -> int:
+        """Calculate how much a move changes the game score for the side making it.
+
+        :param board: State of board before the move
+        :param move: Move to be played
+        """
+        if not move:
+            # Null move
+            return 0
+        if board.turn:
+            own, other = PST_WHITE, PST_BLACK
+        else:
+            own, other = PST_BLACK, PST_WHITE
+        piece_type = board.piece_type_at(move.from_square)
+        pst = own[piece_type]
+        delta = pst[move.to_square] - pst[move.from_square]
+        if move.promotion:
+            delta += (PIECE_VALUES[move.promotion] + own[move.promotion][move.to_square] -
+                      PIECE_VALUES[chess.PAWN] - pst[move.to_square])
+        if piece_type == chess.KING and board.is_castling(move):
+            # The rook moves along with the king
+            rank = chess.square_rank(move.from_square)
+            if board.is_kingside_castling(move):
+                rook_from, rook_to = chess.square(7, rank), chess.square(5, rank)
             else:
-                score -= pst[board.piece_type_at(pos)][63 - pos] + piece[board.piece_type_at(pos)]
-        return score if board.turn else -score
+                rook_from, rook_to = chess.square(0, rank), chess.square(3, rank)
+            delta += own[chess.ROOK][rook_to] - own[chess.ROOK][rook_from]
+        elif piece_type == chess.PAWN and board.is_en_passant(move):
+            # The captured pawn is behind the target square
+            delta += PIECE_VALUES[chess.PAWN] + other[chess.PAWN][move.to_square ^ 8]
+        else:
+            captured = board.piece_type_at(move.to_square)
+            if captured:
+                delta += PIECE_VALUES[captured] + other[captured][move.to_square]
+        return delta
+
+    def probe(self, key: int, alpha: int, beta: int, depth: int) -> tuple:
+        """Look up a stored result for a position searched at least as deep.
+
+        :param key: Zobrist hash of the position
+        :returns: score to return right away or None, and the narrowed window
+        """
+        entry = self.tt.get(key)
+        if entry is None or entry[0] < depth:
+            return None, alpha, beta
+        _, score, flag, _ = entry
+        if flag == EXACT:
+            return score, alpha, beta
+        if flag == LOWER:
+            alpha = max(alpha, score)
+        else:
+            beta = min(beta, score)
+        return (score if alpha >= beta else None), alpha, beta
 
     def quiesce(self, board: chess.Board, alpha: int, beta: int) -> int:
         """Check until game state is calm and quiet."""
+        self.nodes += 1
+        key = chess.polyglot.zobrist_hash(board)
+        score, alpha, beta = self.probe(key, alpha, beta, 0)
+        if score is not None:
+            return score
         stand_pat = self.evaluate_board(board)
         if stand_pat >= beta:
+            self.tt[key] = (0, beta, LOWER, None)
             return beta
         if alpha < stand_pat:
             alpha = stand_pat
-        for move in board.legal_moves:
-            if board.is_capture(move):
-                board.push(move)
-                score = -self.quiesce(board, -beta, -alpha)
-                board.pop()
-                if score > alpha:
-                    if score >= beta:
-                        return beta
-                    alpha = score
+        best_move = None
+        # Only captures are generated, biggest victims first
+        captures = sorted(board.generate_legal_captures(), key=lambda move: self.mvv_lva(board, move),
+                          reverse=True)
+        for move in captures:
+            self.make(board, move)
+            score = -self.quiesce(board, -beta, -alpha)
+            self.unmake(board)
+            if score > alpha:
+                if score >= beta:
+                    self.tt[key] = (0, beta, LOWER, move)
+                    return beta
+                alpha = score
+                best_move = move
+        self.tt[key] = (0, alpha, EXACT if best_move else UPPER, best_move)
         return alpha
 
     def negamax_search(self, board: chess.Board, depth: int) -> int:
@@ -181,37 +379,109 @@ class ChessEngine:
             return self.evaluate_board(board)
         maxScore = -1000
         for move in board.legal_moves:
-            board.push(move)
+            self.make(board, move)
             score = -self.negamax_search(board, depth - 1)
             if score > maxScore:
                 maxScore = score
-            board.pop()
+            self.unmake(board)
         return maxScore
 
-    def alphaBeta(self, board: chess.Board, alpha: int, beta: int, depth: int) -> int:
+    def alphaBeta(self, board: chess.Board, alpha: int, beta: int, depth: int, ply: int = 0) -> int:
         """Execute alpha beta pruning."""
-        if board.outcome():
-            # Test for mates and draws
-            return alpha if board.is_checkmate() else 0
+        self.nodes += 1
+        # Test for mates and draws, leaving out the repetition and move
+        # counter rules that outcome() would walk the move stack for
+        if board.is_insufficient_material():
+            return 0
         if depth == 0:
+            if board.is_checkmate():
+                return alpha
+            if board.is_stalemate():
+                return 0
             return self.quiesce(board, alpha, beta)
-        moves = self.ordered(board)
-        for move in moves:
-            board.push(move)
-            score = -self.alphaBeta(board, -beta, -alpha, depth - 1)
-            board.pop()
+        key = chess.polyglot.zobrist_hash(board)
+        score, alpha, beta = self.probe(key, alpha, beta, depth)
+        if score is not None:
+            return score
+        # The legal moves are generated once, both to find mates and to search
+        legal_moves = list(board.legal_moves)
+        if not legal_moves:
+            return alpha if board.is_check() else 0
+        if (depth >= 3 and beta - alpha == 1 and board.move_stack and board.peek() and
+                not board.is_check() and self.has_non_pawn_material(board)):
+            # Null move pruning: if passing the turn still fails high, a real
+            # move would too. Skipped in pawn endings because of zugzwang.
+            self.make(board, chess.Move.null())
+            score = -self.alphaBeta(board, -beta, -beta + 1, depth - 1 - NULL_MOVE_REDUCTION, ply + 1)
+            self.unmake(board)
+            if score >= beta:
+                return beta
+        entry = self.tt.get(key)
+        best_move = None
+        moves = self.ordered(board, legal_moves, entry[3] if entry else None, ply)
+        for move_number, move in enumerate(moves):
+            is_capture = board.is_capture(move)
+            self.make(board, move)
+            if move_number == 0:
+                score = -self.alphaBeta(board, -beta, -alpha, depth - 1, ply + 1)
+            else:
+                # Late move reductions for quiet moves after the first few
+                reduction = 0
+                if (move_number >= FULL_DEPTH_MOVES and depth >= 3 and not is_capture and
+                        not move.promotion and not board.is_check()):
+                    reduction = 2 if depth >= 6 else 1
+                # Principal variation search: prove the move is no better than
+                # alpha with a null window, search it fully only if it is
+                score = -self.alphaBeta(board, -alpha - 1, -alpha, depth - 1 - reduction, ply + 1)
+                if score > alpha and (reduction or score < beta):
+                    score = -self.alphaBeta(board, -beta, -alpha, depth - 1, ply + 1)
+            self.unmake(board)
             if score > alpha:
                 if score >= beta:
+                    if not is_capture:
+                        self.add_killer(move, ply)
+                    self.tt[key] = (depth, beta, LOWER, move)
                     return beta
                 alpha = score
+                best_move = move
+        self.tt[key] = (depth, alpha, EXACT if best_move else UPPER, best_move)
         return alpha
 
-    def ordered(self, board: chess.Board) -> list:
-        """Order legal moves by captures."""
-        moves = []
-        for move in board.legal_moves:
-            if board.is_capture(move):
-                moves.insert(0, move)
+    def has_non_pawn_material(self, board: chess.Board) -> bool:
+        """Check if the side to move has pieces other than pawns and king."""
+        pieces = board.knights | board.bishops | board.rooks | board.queens
+        return bool(pieces & board.occupied_co[board.turn])
+
+    def ordered(self, board: chess.Board, moves: list, hash_move: chess.Move = None, ply: int = 0) -> list:
+        """Order legal moves for searching.
+
+        The hash move goes first, then captures by most valuable victim and
+        least valuable attacker, then killer moves and the remaining quiet moves.
+        """
+        killers = self.killers.get(ply, ())
+        first, captures, killer_moves, quiets = [], [], [], []
+        for move in moves:
+            if move == hash_move:
+                first.append(move)
+            elif board.is_capture(move):
+                captures.append(move)
+            elif move in killers:
+                killer_moves.append(move)
             else:
-                moves.append(move)
-        return moves
+                quiets.append(move)
+        captures.sort(key=lambda move: self.mvv_lva(board, move), reverse=True)
+        return first + captures + killer_moves + quiets
+
+    def mvv_lva(self, board: chess.Board, move: chess.Move) -> int:
+        """Score a capture by its victim and attacker."""
+        # En passant leaves the target square empty
+        victim = board.piece_type_at(move.to_square) or chess.PAWN
+        attacker = board.piece_type_at(move.from_square)
+        return PIECE_VALUES[victim] * 10 - PIECE_VALUES[attacker]
+
+    def add_killer(self, move: chess.Move, ply: int):
+        """Remember a quiet move that caused a beta cutoff at this ply."""
+        killers = self.killers.setdefault(ply, [])
+        if move not in killers:
+            killers.insert(0, move)
+            del killers[2:]
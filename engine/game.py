@@ -1,7 +1,6 @@
 import click
 import chess
 import sys
-from time import sleep
 from .engine import ChessEngine
 
 
@@ -45,11 +44,12 @@ class ChessGame:
     def engine_move(self):
         """Update the board according to which move the engine makes."""
         move = self.engine.next_move(self.board)
-        self.board.push_san(move)
+        move_san = self.board.san(move)
+        self.board.push(move)
         click.echo("-"*15)
         click.echo(self.board)
         click.echo("-"*15)
-        click.echo(self.engine_color + " plays: " + move)
+        click.echo(self.engine_color + " plays: " + move_san)
         click.echo()
         self.check_game_state()
         self.player_move()
@@ -59,4 +59,5 @@ class ChessGame:
         outcome = self.board.outcome()
         if outcome:
             click.echo("Game has ended: " + outcome.result())
+            self.engine.close()
             sys.exit("Rekt")